@@ -1,131 +1,356 @@
-from enum import Enum
+from array import array
 import math
-from random import shuffle
-
-class Player(Enum):
-    O = 'O'
-    X = 'X'
+from random import Random
+
+# Grid states and players
+EMPTY, O, X = 0, 1, 2
+SYMBOLS:tuple[str] = (None, 'O', 'X')
+
+# Transposition table bound flags
+EXACT, LB, UB = 0, 1, 2
+
+# Zobrist keys for each grid and state (empty, O, X), extended by Board for larger sizes
+# Seeded so that searches and the AI's moves are reproducible
+ZOBRIST_RANDOM:Random = Random(3)
+ZOBRIST:list[list[int]] = [[ZOBRIST_RANDOM.getrandbits(64) for _ in range(3)] for _ in range(10**2)]
+ZOBRIST_TURN:int = ZOBRIST_RANDOM.getrandbits(64)
+# Key change of a move by each state on each grid, including the change of side to move
+ZOBRIST_MOVE:list[tuple[int]] = [tuple(keys[EMPTY] ^ k ^ ZOBRIST_TURN for k in keys) for keys in ZOBRIST]
+
+# Transposition table as fixed-size parallel arrays, a state lives in slot key & TT_MASK
+# A slot is empty while its depth is 0, and is replaced by any search at least as deep
+TT_SIZE:int = 1 << 16
+TT_MASK:int = TT_SIZE - 1
+TT_KEY:array = array('Q', bytes(8 * TT_SIZE))
+TT_VALUE:array = array('d', bytes(8 * TT_SIZE)) # Floats, as heuristic values are fractions
+TT_FLAG:array = array('B', bytes(TT_SIZE))
+TT_DEPTH:array = array('B', bytes(TT_SIZE))
+TT_GRID:array = array('B', bytes(TT_SIZE))
+SEARCH_DEPTH:int = 8 # Deepest iteration for boards larger than the default
+MAX_GRIDS:int = 255 # TT_DEPTH and TT_GRID store depths and grids in one byte
+
+POLICY:dict[int, int] = None # Best grid of every state on the default board, solved lazily
+
+def create_win_masks(size:int) -> list[int]:
+    '''Bitmask of every winning line on a board of given size'''
+    verticals:list[int] = [sum(1 << (i + j*size) for j in range(size)) for i in range(size)]
+    horizontals:list[int] = [sum(1 << (i*size + j) for j in range(size)) for i in range(size)]
+    diagonals:list[int] = [sum(1 << (i*(size+1)) for i in range(size)), sum(1 << ((i+1)*(size-1)) for i in range(size))]
+    return verticals + horizontals + diagonals
+
+def create_move_order(size:int, win_masks:list[int]) -> list[int]:
+    '''Grids sorted by number of winning lines passing through them'''
+    lines_through:list[int] = [sum(1 for m in win_masks if m >> g & 1) for g in range(size**2)]
+    return sorted(range(size**2), key=lambda g: -lines_through[g])
+
+# Tables of the default 3x3 board
+WIN_MASKS_3:tuple[int] = (0b001001001, 0b010010010, 0b100100100,
+                          0b000000111, 0b000111000, 0b111000000,
+                          0b100010001, 0b001010100)
+MOVE_ORDER_3:tuple[int] = (4, 0, 2, 6, 8, 1, 3, 5, 7) # Center, corners, edges
+WINS_3:bytes = bytes(any(occ & m == m for m in WIN_MASKS_3) for occ in range(1 << 9)) # 1 if bitboard covers a line
+
+# Rotations and reflections of the 3x3 board, grid i of the transformed board is grid SYM_3[k][i]
+SYM_3:tuple[tuple[int]] = tuple(tuple(f(i // 3, i % 3) for i in range(9)) for f in (
+    lambda r, c: 3*r + c,       lambda r, c: 3*c + 2 - r,
+    lambda r, c: 3*(2-r) + 2-c, lambda r, c: 3*(2-c) + r,
+    lambda r, c: 3*r + 2-c,     lambda r, c: 3*(2-r) + c,
+    lambda r, c: 3*c + r,       lambda r, c: 3*(2-c) + 2-r))
+SYM_INV_3:tuple[tuple[int]] = tuple(tuple(sym.index(g) for g in range(9)) for sym in SYM_3)
+SYM_OCC_3:tuple[tuple[int]] = tuple(tuple(sum(1 << i for i in range(9) if occ >> sym[i] & 1) for occ in range(1 << 9)) for sym in SYM_3)
 
 class Board:
 
+    TABLES:dict[int, tuple[list[int], list[int], int]] = {} # Tables of each size, built once
+
     def __init__(self, size:int = 3):   
-        
-        def create_board(size:int) -> list[None]:
-            '''Create a new board'''
-            return [None]*(size**2)        
+
+        def create_tables(size:int) -> tuple[list[int], list[int], int]:
+            '''Win masks, move order and Zobrist hash of an empty board'''
+            if size < 1 or size**2 > MAX_GRIDS:
+                raise ValueError(f'Board size must be between 1 and {math.isqrt(MAX_GRIDS)}, got {size}')
+            for _ in range(len(ZOBRIST), size**2):
+                keys:list[int] = [ZOBRIST_RANDOM.getrandbits(64) for _ in range(3)]
+                ZOBRIST.append(keys)
+                ZOBRIST_MOVE.append(tuple(keys[EMPTY] ^ k ^ ZOBRIST_TURN for k in keys))
+            win_masks:list[int] = WIN_MASKS_3 if size == 3 else create_win_masks(size)
+            move_order:list[int] = MOVE_ORDER_3 if size == 3 else create_move_order(size, win_masks)
+            key:int = 0
+            for i in range(size**2):
+                key ^= ZOBRIST[i][EMPTY]
+            return win_masks, move_order, key
+
+        if size not in Board.TABLES:
+            Board.TABLES[size] = create_tables(size)
+        win_masks, move_order, key = Board.TABLES[size]
 
         self.size:int = size
-        self.board:list[Player] = create_board(size)
+        self.occ_o:int = 0 # Bit i set if grid i belongs to O
+        self.occ_x:int = 0 # Bit i set if grid i belongs to X
+        self.win_masks:list[int] = win_masks
+        self.move_order:list[int] = move_order
+        self.hash:int = key
 
-    def place(self, idx:int, player:Player):
+    def place(self, idx:int, player:int):
         '''Place player on the board'''
 
         def duplicate_board() -> Board:
             board_new:Board = Board(self.size)
-            board_new.board:list[int] = self.board.copy()
+            board_new.occ_o = self.occ_o
+            board_new.occ_x = self.occ_x
+            board_new.hash = self.hash
             return board_new
 
         board_new:Board = duplicate_board()
-        board_new.board[idx] = player  
+        board_new.place_inplace(idx, player)
         return board_new 
 
-    def check_win(self, player:Player) -> bool:
-        '''Check if player wins the game'''
-
-        def check_line(line:list[Player]) -> bool:
-            '''Check if all values in line belongs to Player'''
-            return all(player == elem for elem in line)
-
-        verticals:list[list[int]] = [self.board[i::self.size] for i in range(0,self.size)]
-        horizontals:list[list[int]] = [self.board[i:i+self.size] for i in range(0,self.size**2,self.size)]
-        diagonals:list[list[int]] = [self.board[::self.size+1],  self.board[self.size-1:self.size**2-1:self.size-1]]
-
-        all_lines:list[list[int]] = verticals + horizontals + diagonals
-        is_win:bool = any(check_line(l) for l in all_lines)
-        return is_win
+    def place_inplace(self, idx:int, player:int):
+        '''Place player on this board without copying, overwriting any player on grid idx'''
+        if (self.occ_o | self.occ_x) >> idx & 1:
+            self.undo(idx)
+        if player == O:
+            self.occ_o |= 1 << idx
+        else:
+            self.occ_x |= 1 << idx
+        self.hash ^= ZOBRIST[idx][EMPTY] ^ ZOBRIST[idx][player]
+
+    def undo(self, idx:int):
+        '''Remove the player placed on grid idx, if any'''
+        bit:int = 1 << idx
+        if not (self.occ_o | self.occ_x) & bit:
+            return
+        player:int = O if self.occ_o & bit else X
+        self.occ_o &= ~bit
+        self.occ_x &= ~bit
+        self.hash ^= ZOBRIST[idx][EMPTY] ^ ZOBRIST[idx][player]
 
     def get_num_empty(self) -> int:
         '''Find number of empty spaces in board'''
-        return self.board.count(None)
+        return self.size**2 - (self.occ_o | self.occ_x).bit_count()
 
     def get_grid_empty(self) -> list[int]:
-        '''Find which grid in the board is empty'''
-        return [i for i,v in enumerate(self.board) if v == None]
-    
-    def is_no_more_move(self) -> bool:
-        return (self.get_num_empty() == 0)
-
-class AI:
-
-    def is_terminal(board:Board) -> int:
-        '''Check if the state is a terminal state'''
-        is_no_more_move:bool = board.is_no_more_move()
-        is_win:bool = any(board.check_win(p) for p in Player)
-        return is_no_more_move or is_win
-
-    def evaluate(board:Board) -> int:
-        '''Return the value of terminal state'''
-        if board.is_no_more_move():
-            return 0 # Tie
-        reward:int = board.get_num_empty() + 1
-        return reward if board.check_win(Player.O) else -reward
-
-    def get_opponent(player:Player):
-        return Player.X if player == Player.O else Player.O
-
-    def minimax(board:Board, player:Player, alpha:float = -math.inf, beta:float = math.inf) -> tuple[int, int]:
-
-        def play_maximise():
-            nonlocal alpha, beta
-            reward_best:int = -math.inf
-            grid_best:int = None
-
-            for grid in board.get_grid_empty():
-                board_next:Board = board.place(grid, player)
-                reward_next, _ = AI.minimax(board_next, AI.get_opponent(player), alpha, beta)
-                if reward_next > reward_best:
-                    reward_best = reward_next
-                    grid_best = grid
-                    alpha = max(alpha, reward_best)
-                    if beta <= alpha:
-                        break
-
-            return reward_best, grid_best
-        
-        def play_minimise():
-            nonlocal alpha, beta
-            reward_best:int = math.inf
+        '''Find which grid in the board is empty, strongest grids first'''
+        occ:int = self.occ_o | self.occ_x
+        return [g for g in self.move_order if not occ >> g & 1]
+
+    def get_key(self, player:int) -> int:
+        '''Zobrist hash of the board with player to move'''
+        return self.hash ^ (ZOBRIST_TURN if player == X else 0)
+
+    def get_board(self) -> bytearray:
+        '''Grid states (EMPTY, O or X), one byte per grid'''
+        board:bytearray = bytearray(self.size**2)
+        for player, occ in ((O, self.occ_o), (X, self.occ_x)):
+            while occ:
+                board[(occ & -occ).bit_length() - 1] = player
+                occ &= occ - 1
+        return board
+
+def status_bits(occ_own:int, occ_opp:int, num_empty:int, win_masks:list[int]) -> tuple[bool, int]:
+    '''Check if the state is terminal and its value for the owner of occ_own, in one scan of the lines'''
+    for m in win_masks:
+        if occ_own & m == m:
+            return True, num_empty + 1
+        if occ_opp & m == m:
+            return True, -num_empty - 1
+    return num_empty == 0, 0 # Tie if no more move
+
+def status_bits_3(occ_own:int, occ_opp:int, num_empty:int) -> tuple[bool, int]:
+    '''status_bits on the 3x3 board, by looking up each bitboard in WINS_3'''
+    if WINS_3[occ_own]:
+        return True, num_empty + 1
+    if WINS_3[occ_opp]:
+        return True, -num_empty - 1
+    return num_empty == 0, 0 # Tie if no more move
+
+def heuristic_bits(occ_own:int, occ_opp:int, win_masks:list[int]) -> float:
+    '''Estimate a non-terminal state by its open lines, within (-1, 1) so any win outweighs it'''
+    open_own:int = sum(1 for m in win_masks if not occ_opp & m)
+    open_opp:int = sum(1 for m in win_masks if not occ_own & m)
+    return (open_own - open_opp) / (len(win_masks) + 1)
+
+def negamax_bits(occ_own:int, occ_opp:int, key:int, player:int, alpha:float, beta:float, depth:int,
+                 win_masks:list[int], move_order:list[int]) -> tuple[float, int]:
+    '''Fail-soft negamax over raw bitboards, value is for player who owns occ_own and is to move
+
+    Runs on an explicit stack instead of recursion. The state being searched lives in
+    local variables, and is pushed as a tuple when descending into a child.
+    key is the Zobrist hash including side to move, and is ignored on the 3x3 board
+    where each state is keyed on its canonical symmetric variant instead.
+    '''
+    keys_move:list[tuple[int]] = ZOBRIST_MOVE
+    sym_occ:tuple[tuple[int]] = SYM_OCC_3
+    tt_key, tt_value, tt_flag, tt_depth, tt_grid = TT_KEY, TT_VALUE, TT_FLAG, TT_DEPTH, TT_GRID
+    is_3:bool = win_masks is WIN_MASKS_3
+    sym:int = None
+    num_grid:int = len(move_order)
+    stack:list[tuple] = []
+
+    while True:
+        # Enter a state, either resolving its value at once or preparing to search its children
+        occ:int = occ_own | occ_opp
+        num_empty:int = num_grid - occ.bit_count()
+        if is_3:
+            is_resolved, value = status_bits_3(occ_own, occ_opp, num_empty)
+        else:
+            is_resolved, value = status_bits(occ_own, occ_opp, num_empty, win_masks)
+        grid:int = None
+        if not is_resolved:
+            if depth >= num_empty:
+                depth = num_empty # Searched to the end of the game
+            elif depth <= 0:
+                value = heuristic_bits(occ_own, occ_opp, win_masks)
+                is_resolved = True
+
+        if not is_resolved:
+            # Probe transposition table, keyed on the smallest symmetric variant of a 3x3 board
+            if is_3:
+                keys:list[int] = [t[occ_own] << 9 | t[occ_opp] for t in sym_occ]
+                key = min(keys)
+                sym = keys.index(key)
+            alpha_orig:float = alpha
+            beta_orig:float = beta
+            slot:int = key & TT_MASK
+            grid_tt:int = None
+            if tt_depth[slot] and tt_key[slot] == key:
+                grid_tt = tt_grid[slot] if sym is None else SYM_3[sym][tt_grid[slot]]
+                # Bounds only cut off, as a search in a window they tightened could return a losing grid
+                if tt_depth[slot] >= depth:
+                    flag:int = tt_flag[slot]
+                    value = tt_value[slot]
+                    if flag == EXACT or (flag == LB and value >= beta) or (flag == UB and value <= alpha):
+                        is_resolved = True
+                        grid = grid_tt
+
+        if not is_resolved:
+            # Try the best grid from a previous search first
+            grids:list[int] = [g for g in move_order if not occ >> g & 1]
+            if grid_tt is not None:
+                grids.remove(grid_tt)
+                grids.insert(0, grid_tt)
+            index:int = 0
+            value_best:float = -math.inf
             grid_best:int = None
 
-            for grid in board.get_grid_empty():
-                board_next:Board = board.place(grid, player)
-                reward_next, _ = AI.minimax(board_next, AI.get_opponent(player), alpha, beta)
-                if reward_next < reward_best:
-                    reward_best = reward_next
-                    grid_best = grid
-                    beta = min(beta, reward_best)
-                    if beta <= alpha:
-                        break
-
-            return reward_best, grid_best
+        # Return resolved values to parent states until one has a child left to search
+        while is_resolved:
+            if not stack:
+                return value, grid
+            (occ_own, occ_opp, key, sym, player, alpha, beta, depth, grids, index,
+             value_best, grid_best, alpha_orig, beta_orig) = stack.pop()
+            value = -value
+            if value > value_best:
+                value_best = value
+                grid_best = grids[index - 1]
+                if value > alpha:
+                    alpha = value
+            if alpha < beta and index < len(grids):
+                break
+            # Store result with its bound relative to the original window
+            slot:int = key & TT_MASK
+            if tt_depth[slot] <= depth:
+                if value_best <= alpha_orig:
+                    tt_flag[slot] = UB
+                elif value_best >= beta_orig:
+                    tt_flag[slot] = LB
+                else:
+                    tt_flag[slot] = EXACT
+                tt_key[slot] = key
+                tt_value[slot] = value_best
+                tt_depth[slot] = depth
+                tt_grid[slot] = grid_best if sym is None else SYM_INV_3[sym][grid_best]
+            value, grid = value_best, grid_best
+
+        # Descend into the next child
+        grid = grids[index]
+        stack.append((occ_own, occ_opp, key, sym, player, alpha, beta, depth, grids, index + 1,
+                      value_best, grid_best, alpha_orig, beta_orig))
+        occ_own, occ_opp = occ_opp, occ_own | 1 << grid
+        if not is_3:
+            key ^= keys_move[grid][player]
+        player = 3 - player
+        alpha, beta = -beta, -alpha
+        depth -= 1
 
-        if AI.is_terminal(board):
-            return AI.evaluate(board), None
+class AI:
 
-        return play_maximise() if player == Player.O else play_minimise()
+    def status(board:Board) -> tuple[bool, int]:
+        '''Check if the state is a terminal state and return its value'''
+        return status_bits(board.occ_o, board.occ_x, board.get_num_empty(), board.win_masks)
+
+    def get_opponent(player:int):
+        return 3 - player
+
+    def minimax(board:Board, player:int, alpha:float = -math.inf, beta:float = math.inf, depth:int = None) -> tuple[float, int]:
+        '''Best value and grid for player, value is positive if O is winning'''
+        key:int = None if board.size == 3 else board.get_key(player)
+        if depth is None:
+            depth = board.get_num_empty()
+        if player == O:
+            return negamax_bits(board.occ_o, board.occ_x, key, O, alpha, beta, depth, board.win_masks, board.move_order)
+        value, grid = negamax_bits(board.occ_x, board.occ_o, key, X, -beta, -alpha, depth, board.win_masks, board.move_order)
+        return -value, grid
+
+    def iterative_deepening(board:Board, player:int, depth_max:int, window:float = 1) -> tuple[float, int]:
+        '''Search with increasing depth, each iteration within an aspiration window around the last value'''
+        value, grid = AI.minimax(board, player, depth=1)
+        for depth in range(2, min(depth_max, board.get_num_empty()) + 1):
+            alpha, beta = value - window, value + window
+            value, grid = AI.minimax(board, player, alpha, beta, depth)
+            if value <= alpha or value >= beta:
+                value, grid = AI.minimax(board, player, depth=depth) # Outside window, search again
+        return value, grid
+
+    def choose(board:Board, player:int) -> int:
+        '''Best grid for player, looked up from the policy on the default board'''
+        if board.size == 3:
+            grid:int = load_policy().get(board.get_key(player))
+            if grid is not None:
+                return grid
+            _, grid = AI.minimax(board, player)
+            return grid
+        _, grid = AI.iterative_deepening(board, player, SEARCH_DEPTH)
+        return grid
+
+def solve_policy(size:int = 3) -> dict[int, int]:
+    '''Best grid of every reachable state, with either player moving first'''
+    policy:dict[int, int] = {}
+    board:Board = Board(size)
+
+    def visit(player:int):
+        key:int = board.get_key(player)
+        if key in policy or AI.status(board)[0]:
+            return
+        _, policy[key] = AI.minimax(board, player)
+        for grid in board.get_grid_empty():
+            board.place_inplace(grid, player)
+            visit(AI.get_opponent(player))
+            board.undo(grid)
+
+    visit(O)
+    visit(X)
+    return policy
+
+def load_policy() -> dict[int, int]:
+    '''Default board policy, solved in memory on first use'''
+    global POLICY
+    if POLICY is None:
+        POLICY = solve_policy()
+    return POLICY
 
 class Game:
 
     def __init__(self):
-        self.player:Player = Player.O
+        self.player:int = O
         self.board:Board = Board()
 
     def switch(self):
-        self.player = (Player.X if self.player == Player.O else Player.O)
+        self.player = 3 - self.player
 
     def play(self):
 
-        def place(player:Player, idx:int = None):
+        def place(player:int, idx:int = None):
             if idx == None:
                 raw:str = input("Where do you wish to place your character? ").strip()
                 idx:int = int(raw)
@@ -134,16 +359,16 @@ class Game:
 
         while True:
             # Your Turn
-            if AI.is_terminal(self.board):
+            if AI.status(self.board)[0]:
                 break
-            place(Player.O)
-            print(self.board.board)
+            place(O)
+            print([SYMBOLS[g] for g in self.board.get_board()])
             # AI Turn
-            if AI.is_terminal(self.board):
+            if AI.status(self.board)[0]:
                 break
-            reward_best, grid_next = AI.minimax(self.board, Player.X)
-            place(Player.X, grid_next)
-            print(self.board.board)
+            grid_next:int = AI.choose(self.board, X)
+            place(X, grid_next)
+            print([SYMBOLS[g] for g in self.board.get_board()])
 
 Game().play()
 